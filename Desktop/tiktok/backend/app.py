@@ -28,6 +28,14 @@ from google_drive import upload_slideshow_output, GoogleDriveError
 
 # Global progress tracking
 progress_status = {}
+progress_changed = threading.Condition()  # notified on every progress update
+
+# Max seconds a status request waits for a newer update (long polling)
+STATUS_LONG_POLL_TIMEOUT = 25
+
+# Finished sessions keep their status this long (seconds) before being dropped
+PROGRESS_RETENTION = 600
+progress_expiry = {}  # session_id -> time its status may be dropped
 
 app = Flask(__name__)
 CORS(app)
@@ -58,20 +66,48 @@ def health_check():
 
 @app.route('/api/status/<session_id>', methods=['GET'])
 def get_status(session_id):
-    """Get progress status for a session"""
-    if session_id in progress_status:
-        return jsonify(progress_status[session_id])
+    """
+    Get progress status for a session.
+
+    With ?since=<version>, waits up to STATUS_LONG_POLL_TIMEOUT seconds for
+    an update newer than that version instead of answering immediately.
+    """
+    since = request.args.get('since', type=int)
+    with progress_changed:
+        _expire_progress()
+        if since is not None:
+            progress_changed.wait_for(
+                lambda: session_id not in progress_status
+                or progress_status[session_id]['version'] > since,
+                timeout=STATUS_LONG_POLL_TIMEOUT
+            )
+        status = progress_status.get(session_id)
+    if status is not None:
+        return jsonify(status)
     return jsonify({'step': 'unknown', 'message': 'Session not found', 'progress': 0})
 
 
+def _expire_progress():
+    """Drop every finished session past its retention in one pass (caller holds progress_changed)"""
+    now = time.time()
+    for session_id in [sid for sid, expires in progress_expiry.items() if expires <= now]:
+        del progress_expiry[session_id]
+        progress_status.pop(session_id, None)
+
+
 def update_progress(session_id, step, message, progress, details=None):
-    """Update progress status for a session"""
-    progress_status[session_id] = {
-        'step': step,
-        'message': message,
-        'progress': progress,
-        'details': details or {}
-    }
+    """Update progress status for a session and wake long-polling requests"""
+    with progress_changed:
+        _expire_progress()
+        previous = progress_status.get(session_id)
+        progress_status[session_id] = {
+            'step': step,
+            'message': message,
+            'progress': progress,
+            'details': details or {},
+            'version': previous['version'] + 1 if previous else 1
+        }
+        progress_changed.notify_all()
 
 
 def run_generation(session_id, tiktok_url, folder_name, product_context,
@@ -173,9 +209,10 @@ def run_generation(session_id, tiktok_url, folder_name, product_context,
         update_progress(session_id, 'error', f'Unexpected error: {str(e)}', 0)
 
     finally:
-        # Clean up progress after 10 minutes
-        time.sleep(600)
-        progress_status.pop(session_id, None)
+        # Keep the final status for PROGRESS_RETENTION seconds; expired sessions
+        # are swept on later status reads/updates instead of by a sleeping thread
+        with progress_changed:
+            progress_expiry[session_id] = time.time() + PROGRESS_RETENTION
 
 
 @app.route('/api/generate', methods=['POST'])
@@ -256,7 +293,7 @@ def generate_slideshow():
         return jsonify({
             'status': 'started',
             'session_id': session_id,
-            'message': 'Generation started. Poll /api/status/{session_id} for progress.'
+            'message': 'Generation started. Poll /api/status/{session_id}?since={version} for progress.'
         })
 
     except ValueError as e:
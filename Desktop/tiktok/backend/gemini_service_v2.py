@@ -4,14 +4,23 @@ Single analysis call + parallel image generation
 With persona consistency and smart product insertion
 """
 import os
+import io
+import re
 import json
+import hashlib
 import base64
 import time
+import random
+import asyncio
+import shutil
+import tempfile
 import threading
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Optional, Callable
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from PIL import Image, ImageOps
 
 load_dotenv()
 
@@ -21,6 +30,22 @@ logger = get_logger('gemini')
 
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
+
+# orjson is optional - fall back to stdlib json when it isn't installed
+try:
+    import orjson
+    USE_ORJSON = True
+except ImportError:
+    USE_ORJSON = False
+
+# pyvips (libvips) is optional - it streams decode + resize with far less memory
+# than Pillow; OSError covers the Python package without the libvips library
+try:
+    import pyvips
+    USE_PYVIPS = True
+except (ImportError, OSError):
+    USE_PYVIPS = False
 
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
@@ -34,44 +59,120 @@ RPM_LIMIT = 60
 MAX_RETRIES = 3
 REQUEST_TIMEOUT = 120  # seconds per API call
 
+# Shared decoder for pulling the JSON object out of model responses
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _parse_json_object(text: str, start: int) -> dict:
+    """Decode the JSON object beginning at text[start], ignoring trailing text"""
+    if USE_ORJSON and text.rstrip().endswith('}'):
+        try:
+            return orjson.loads(text[start:])
+        except orjson.JSONDecodeError:
+            pass  # trailing prose after the object - let raw_decode skip it
+    obj, _ = _JSON_DECODER.raw_decode(text, start)
+    return obj
+
+
+def _dump_json(obj) -> bytes:
+    """Serialize obj as indented UTF-8 JSON"""
+    if USE_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+# In-memory cache of image file contents, bounded by total bytes (keyed by path + mtime)
+IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Image extension -> MIME type
+IMAGE_MIME_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp'
+}
+
+# Generation inputs (style/persona/product images) are uploaded once through the
+# Files API and referenced by handle; uploads expire server-side after 48h
+USE_FILES_API = os.getenv('GEMINI_FILES_API', 'true').lower() == 'true'
+UPLOADED_FILE_TTL = 47 * 3600  # seconds - re-upload shortly before expiry
+
+# Persistent cache of generated images keyed by a hash of all generation inputs
+USE_GENERATED_CACHE = os.getenv('GENERATED_CACHE_ENABLED', 'true').lower() == 'true'
+GENERATED_CACHE_DIR = os.getenv('GENERATED_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'temp', 'generated_cache'))
+GENERATED_CACHE_MAX_BYTES = int(os.getenv('GENERATED_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# Batch prediction (cheaper, higher throughput, no incremental progress)
+USE_BATCH_API = os.getenv('GEMINI_BATCH_API', 'false').lower() == 'true'
+BATCH_POLL_INTERVAL = 30  # max seconds between job status checks
+BATCH_MIN_POLL_INTERVAL = 2  # first check comes quickly; the interval then backs off
+BATCH_TIMEOUT = 24 * 3600  # batch jobs may take up to a day
+BATCH_DONE_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+
+# Upper bound on per-task progress callbacks per job (large jobs report every Nth task)
+MAX_PROGRESS_UPDATES = 100
+
+# Analysis images are downscaled to fit this box (9:16) and re-encoded as JPEG
+ANALYSIS_IMAGE_SIZE = (768, 1365)
+ANALYSIS_JPEG_QUALITY = 85
+
+# Style/persona references for generation are reduced to this long edge
+REFERENCE_IMAGE_SIZE = (1024, 1024)
+REFERENCE_JPEG_QUALITY = 85
+
+# EXIF tag holding the camera orientation (1 = already upright)
+EXIF_ORIENTATION_TAG = 0x0112
+# Orientations stored rotated by 90 degrees (width and height swap when upright)
+EXIF_TRANSPOSED_ORIENTATIONS = frozenset({5, 6, 7, 8})
+
+# Raised for files Pillow/libvips can't decode (unknown format, truncated data)
+IMAGE_DECODE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+if USE_PYVIPS:
+    IMAGE_DECODE_ERRORS += (pyvips.Error,)
+
 # Rate limiter using semaphore + delay
-class RateLimiter:
+class AsyncRateLimiter:
     """
-    Semaphore-based rate limiter that enforces RPM limits.
-    Ensures delay BEFORE each request, not after.
+    Semaphore-based rate limiter that enforces RPM limits for asyncio tasks.
+    Ensures delay BEFORE each request, not after; waiting tasks await
+    instead of blocking a thread.
     """
     def __init__(self, rpm: int = RPM_LIMIT, max_concurrent: int = MAX_CONCURRENT):
-        self.semaphore = threading.Semaphore(max_concurrent)
+        self.semaphore = asyncio.Semaphore(max_concurrent)
         self.min_interval = 60.0 / rpm  # seconds between requests
-        self.last_request_time = 0.0
-        self.lock = threading.Lock()
-        logger.debug(f"RateLimiter initialized: rpm={rpm}, max_concurrent={max_concurrent}")
-
-    def acquire(self):
-        """Acquire permission to make a request. Blocks if rate limit exceeded."""
-        self.semaphore.acquire()
-        with self.lock:
-            now = time.time()
-            elapsed = now - self.last_request_time
-            if elapsed < self.min_interval:
-                wait_time = self.min_interval - elapsed
-                logger.debug(f"Rate limiter: waiting {wait_time:.2f}s")
-                time.sleep(wait_time)
-            self.last_request_time = time.time()
+        self.next_slot = 0.0  # monotonic time the next request may start
+        logger.debug(f"AsyncRateLimiter initialized: rpm={rpm}, max_concurrent={max_concurrent}")
+
+    async def acquire(self):
+        """Acquire permission to make a request. Awaits if rate limit exceeded."""
+        await self.semaphore.acquire()
+        # Single event loop thread: the reservation needs no lock
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.min_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
 
     def release(self):
         """Release the semaphore after request completes."""
         self.semaphore.release()
 
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
 
 class GeminiServiceError(Exception):
     """Custom exception for Gemini API errors"""
     pass
 
 
-def _get_client(timeout: int = REQUEST_TIMEOUT):
+def _create_client(timeout: int = REQUEST_TIMEOUT):
     """
-    Initialize and return Gemini client with timeout configuration.
+    Initialize and return a new Gemini client with timeout configuration.
 
     Args:
         timeout: HTTP request timeout in seconds (default: REQUEST_TIMEOUT)
@@ -84,51 +185,243 @@ def _get_client(timeout: int = REQUEST_TIMEOUT):
     )
 
 
-def _load_image_bytes(image_path: str) -> bytes:
-    """Load image file as bytes"""
-    with open(image_path, 'rb') as f:
-        return f.read()
+@lru_cache(maxsize=None)
+def _get_client(timeout: int = REQUEST_TIMEOUT):
+    """
+    Return the process-wide Gemini client for synchronous calls.
 
+    One client per timeout is shared by every job and worker thread, so
+    its HTTP connection pool (TCP + TLS) is reused instead of rebuilt per
+    job or per file upload.
+    """
+    return _create_client(timeout)
 
-def _get_image_mime_type(image_path: str) -> str:
-    """Get MIME type from image path"""
-    ext = Path(image_path).suffix.lower()
-    mime_types = {
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg',
-        '.png': 'image/png',
-        '.gif': 'image/gif',
-        '.webp': 'image/webp'
-    }
-    return mime_types.get(ext, 'image/jpeg')
 
+class ImageBytesCache:
+    """
+    Thread-safe LRU cache for image bytes, bounded by total size rather than
+    entry count (a 4K PNG and a small JPEG cost what they actually weigh).
+    """
+    def __init__(self, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
 
-def analyze_and_plan(
-    slide_paths: list[str],
-    product_image_path: str,
-    product_description: str,
-    output_dir: str,
-    request_id: str = None
-) -> dict:
+    def get(self, key) -> Optional[bytes]:
+        """Return cached bytes for key (marking it most recently used) or None."""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data: bytes):
+        """Store bytes for key, evicting least recently used entries over the limit."""
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= len(previous)
+            self.entries[key] = data
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+
+_image_cache = ImageBytesCache()
+
+
+def _load_image(image_path: str) -> tuple[bytes, str]:
+    """Load image file as (bytes, mime type), memoized per path + modification time"""
+    key = ('raw', image_path, os.stat(image_path).st_mtime_ns)
+    data = _image_cache.get(key)
+    if data is None:
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        _image_cache.put(key, data)
+    return data, _get_image_mime_type(image_path)
+
+
+def _image_part(image_path: str):
+    """Build an inline image Part for an image file"""
+    data, mime_type = _load_image(image_path)
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+
+# (path, mtime_ns) -> (File handle, upload time)
+_uploaded_files = {}
+_upload_locks = {}
+_uploaded_files_lock = threading.Lock()
+
+
+def _get_uploaded_file(image_path: str, downscale: bool = False):
     """
-    Single API call to analyze ALL slides and create new story plan.
+    Upload an image through the Files API once and return the cached handle.
 
-    Detects slideshow type, identifies target audience, finds optimal
-    product insertion point, and generates complete slide plan.
+    Concurrent callers for the same file wait on a per-file lock, so each
+    file is uploaded only once; expired handles are dropped on the way.
+    With downscale=True the reduced reference JPEG is uploaded instead.
     """
-    log = get_request_logger('gemini', request_id) if request_id else logger
-    log.info(f"Starting analysis: {len(slide_paths)} slides, product: {product_description[:40]}...")
-    start_time = time.time()
+    key = (image_path, os.stat(image_path).st_mtime_ns, downscale)
+    now = time.time()
+    with _uploaded_files_lock:
+        for stale_key in [k for k, (_, uploaded_at) in _uploaded_files.items()
+                          if now - uploaded_at >= UPLOADED_FILE_TTL]:
+            del _uploaded_files[stale_key]
+            _upload_locks.pop(stale_key, None)
+        path_lock = _upload_locks.setdefault(key, threading.Lock())
+
+    with path_lock:
+        cached = _uploaded_files.get(key)
+        if cached:
+            return cached[0]
+        if downscale:
+            data, mime_type = _load_reference_image(image_path)
+            source = io.BytesIO(data)
+        else:
+            source, mime_type = image_path, _get_image_mime_type(image_path)
+        uploaded = _get_client().files.upload(file=source, config={'mime_type': mime_type})
+        with _uploaded_files_lock:
+            _uploaded_files[key] = (uploaded, time.time())
+        logger.debug("Uploaded %s to Files API as %s", image_path, uploaded.name)
+        return uploaded
 
-    client = _get_client()
-    num_slides = len(slide_paths)
 
-    prompt = f"""You are analyzing a viral TikTok slideshow to recreate it with a product insertion.
+def _forget_uploaded_files(directory: str) -> None:
+    """Drop cached upload handles for files under directory (a finished job's outputs)"""
+    prefix = os.path.join(os.path.abspath(directory), '')
+    with _uploaded_files_lock:
+        for key in [k for k in _upload_locks if os.path.abspath(k[0]).startswith(prefix)]:
+            _upload_locks.pop(key, None)
+            _uploaded_files.pop(key, None)
+
+
+def _reference_image_part(image_path: str, downscale: bool = True):
+    """
+    Image input for generation: Files API handle, or inline bytes as fallback.
+
+    Style/persona references only guide composition, so they are downscaled
+    by default; pass downscale=False for images that must keep full detail.
+    """
+    if USE_FILES_API:
+        try:
+            return _get_uploaded_file(image_path, downscale)
+        except Exception as e:
+            logger.warning(f"Files API upload failed for {image_path}, sending inline: {e}")
+    if downscale:
+        data, mime_type = _load_reference_image(image_path)
+        return types.Part.from_bytes(data=data, mime_type=mime_type)
+    return _image_part(image_path)
+
+
+def _prefetch_reference_images(image_paths: list[str]) -> None:
+    """
+    Downscale (and upload) the given style references concurrently so
+    generation tasks find them ready in the caches. Pillow releases the GIL
+    while resizing/encoding, so threads give real parallelism here.
+    """
+    unique_paths = list(dict.fromkeys(image_paths))
+    if not unique_paths:
+        return
+    with ThreadPoolExecutor(max_workers=min(8, len(unique_paths))) as executor:
+        list(executor.map(_reference_image_part, unique_paths))
+
+
+def _downscale_image(image_path: str, size: tuple[int, int], quality: int) -> bytes:
+    """Resize image to fit within size and return it upright, flattened and JPEG-encoded"""
+    with Image.open(image_path) as img:  # lazy - only the header is read here
+        orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        if (img.format == 'JPEG' and img.mode == 'RGB'
+                and img.width <= size[0] and img.height <= size[1]
+                and orientation == 1):
+            # Already a small upright RGB JPEG - skip the decode/resize/encode round trip
+            with open(image_path, 'rb') as f:
+                return f.read()
+        if USE_PYVIPS:
+            return _downscale_image_vips(image_path, size, quality)
+        # Shrink first so thumbnail() keeps its JPEG draft() decode, then apply
+        # the EXIF rotation (the tag is dropped on re-encode). Orientations 5-8
+        # swap width and height, so fit the stored image to the swapped box.
+        img.thumbnail(size[::-1] if orientation in EXIF_TRANSPOSED_ORIENTATIONS else size, Image.LANCZOS)
+        upright = ImageOps.exif_transpose(img)
+        buf = io.BytesIO()
+        _flatten_to_rgb(upright).save(buf, 'JPEG', quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+def _flatten_to_rgb(img: Image.Image) -> Image.Image:
+    """RGB version of img with any transparency composited onto white"""
+    if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def _downscale_image_vips(image_path: str, size: tuple[int, int], quality: int) -> bytes:
+    """libvips variant of _downscale_image() - shrink-on-load, never decodes the full image"""
+    # thumbnail() applies EXIF orientation itself
+    image = pyvips.Image.thumbnail(image_path, size[0], height=size[1], size='down')
+    if image.interpretation != 'srgb':
+        image = image.colourspace('srgb')
+    if image.hasalpha():
+        image = image.flatten(background=[255, 255, 255])
+    return image.write_to_buffer('.jpg', Q=quality, optimize_coding=True)
+
+
+def _prepare_image_for_upload(
+    image_path: str,
+    size: tuple[int, int] = ANALYSIS_IMAGE_SIZE,
+    quality: int = ANALYSIS_JPEG_QUALITY
+) -> tuple[bytes, str]:
+    """
+    Downscale and JPEG re-encode an image before sending it to Gemini.
+
+    Files the decoder can't handle (e.g. HEIC saved as .jpg) are sent as
+    their original bytes and MIME type instead.
+
+    Returns:
+        (image bytes, mime type) - memoized per path + modification time
+    """
+    key = ('jpeg', image_path, os.stat(image_path).st_mtime_ns, size, quality)
+    data = _image_cache.get(key)
+    if data is None:
+        try:
+            data = _downscale_image(image_path, size, quality)
+        except IMAGE_DECODE_ERRORS as e:
+            logger.warning(f"Could not decode {image_path} for downscaling, sending original: {e}")
+            return _load_image(image_path)
+        _image_cache.put(key, data)
+    return data, 'image/jpeg'
+
+
+def _load_reference_image(image_path: str) -> tuple[bytes, str]:
+    """Downscaled JPEG of a style/persona reference image"""
+    return _prepare_image_for_upload(image_path, REFERENCE_IMAGE_SIZE, REFERENCE_JPEG_QUALITY)
+
+
+def _get_image_mime_type(image_path: str) -> str:
+    """Get MIME type from image path"""
+    return IMAGE_MIME_TYPES.get(os.path.splitext(image_path)[1].lower(), 'image/jpeg')
+
+
+# Analysis prompt, built once at import time. Placeholders: product_description,
+# num_slides, last_body_index. Literal JSON braces are escaped as {{ }}.
+ANALYSIS_PROMPT_TEMPLATE = """You are analyzing a viral TikTok slideshow to recreate it with a product insertion.
 
 USER'S PRODUCT: {product_description}
 
 There are {num_slides} slides in this slideshow. Analyze them ALL.
 
+IMAGES: The {num_slides} slide images follow this prompt in order (slide 0 first).
+The LAST image after them is the USER'S PRODUCT IMAGE (not a slide).
+If an image is identical to an earlier one, a text note like "[SLIDE 3 = SLIDE 1]"
+appears in its place instead of repeating the image.
+
 ═══════════════════════════════════════════════════════════════
 TASK 1: UNDERSTAND THE ORIGINAL SLIDESHOW
 ═══════════════════════════════════════════════════════════════
@@ -260,7 +553,7 @@ IF Type E (Affirmation) or Type F (Other):
 POSITION RULES (all types):
 - NEVER slide 0 (hook) or slide 1 (too early)
 - NEVER the last slide if it's a CTA
-- IDEAL: Middle-to-late position (slide 3 to {num_slides - 2})
+- IDEAL: Middle-to-late position (slide 3 to {last_body_index})
 - Product slide should feel like it BELONGS, not interrupts
 
 ═══════════════════════════════════════════════════════════════
@@ -407,65 +700,216 @@ CRITICAL RULES:
 7. cta_index is null if original has no CTA slide
 """
 
-    # Build content with all images
+
+# Shopping/CTA phrases that should only ever appear on the product slide
+COMPETITOR_KEYWORDS = (
+    'amazon', 'link in bio', 'shop now', 'buy now', '% off', 'discount code',
+    'promo code', 'use code', 'tiktok shop', 'linked below', 'sponsored', '#ad'
+)
+
+
+def _keyword_pattern(keyword: str) -> str:
+    """Regex for keyword as whole words ('#ad' must not match '#adhd', '% off' follows a digit)"""
+    leading = r'\b' if keyword[0].isalnum() else ''
+    return leading + re.escape(keyword) + r'\b'
+
+
+# All keywords compiled into one alternation so each text is scanned once
+_COMPETITOR_PATTERN = re.compile(
+    '|'.join(_keyword_pattern(keyword) for keyword in COMPETITOR_KEYWORDS),
+    re.IGNORECASE
+)
+
+
+def _detect_competitor_signals(slide_texts: list[str]) -> tuple[Optional[int], list[str]]:
+    """
+    Scan slide texts for shopping/CTA signals.
+
+    Returns:
+        (index of the last slide containing a signal or None, matched phrases)
+    """
+    last_index = None
+    matches = []
+    for i, text in enumerate(slide_texts):
+        found = [m.group(0).lower() for m in _COMPETITOR_PATTERN.finditer(text)]
+        if found:
+            last_index = i
+            matches.extend(found)
+    return last_index, matches
+
+
+def _build_analysis_contents(
+    slide_paths: list[str],
+    product_image_path: str,
+    product_description: str
+) -> list:
+    """Build the prompt + image parts for the analysis call"""
+    num_slides = len(slide_paths)
+    prompt = ANALYSIS_PROMPT_TEMPLATE.format(
+        product_description=product_description,
+        num_slides=num_slides,
+        last_body_index=num_slides - 2
+    )
+
+    # Load + downscale all images concurrently before building content
+    all_paths = list(slide_paths) + [product_image_path]
+    with ThreadPoolExecutor(max_workers=min(8, len(all_paths))) as executor:
+        prepared_images = list(executor.map(_prepare_image_for_upload, all_paths))
+
+    # Build content: prompt, then slides in order, then user's product image last
+    # (image order is described once in the prompt instead of per-image labels).
+    # Identical images are sent once; repeats become a short text reference.
     contents = [prompt]
+    seen = {}  # image bytes -> first slide index
+    for i, (data, mime_type) in enumerate(prepared_images):
+        if data in seen:
+            label = "USER'S PRODUCT IMAGE" if i == num_slides else f"SLIDE {i}"
+            contents.append(f"[{label} = SLIDE {seen[data]}]")
+            continue
+        seen[data] = i
+        contents.append(types.Part.from_bytes(data=data, mime_type=mime_type))
+    return contents
+
+
+def _parse_analysis_response(result_text: str, num_slides: int, log) -> dict:
+    """Extract the analysis JSON from the model response and validate its structure"""
+    # Parse JSON in one pass from the first brace (ignores any trailing text)
+    start = result_text.find('{')
+    if start < 0:
+        log.error("No valid JSON in analysis response")
+        raise GeminiServiceError('No valid JSON in response')
+    analysis = _parse_json_object(result_text, start)
+
+    # Validate structure
+    if 'new_slides' not in analysis:
+        log.error("Missing new_slides in analysis")
+        raise GeminiServiceError('Missing new_slides in analysis')
+    if len(analysis['new_slides']) != num_slides:
+        log.error(f"Slide count mismatch: expected {num_slides}, got {len(analysis['new_slides'])}")
+        raise GeminiServiceError(f"Expected {num_slides} slides, got {len(analysis['new_slides'])}")
+
+    # Single pass: required keys on every slide + exactly one product slide
+    product_count = 0
+    for i, slide in enumerate(analysis['new_slides']):
+        slide_type = slide.get('slide_type')
+        if slide_type is None or 'slide_index' not in slide:
+            log.error(f"Slide {i} missing slide_type or slide_index")
+            raise GeminiServiceError(f"Slide {i} missing slide_type or slide_index")
+        if slide_type == 'product':
+            product_count += 1
+            if product_count > 1:
+                log.error("Product slide count error: expected 1, got 2+")
+                raise GeminiServiceError("Expected exactly 1 product slide, got 2+")
+    if product_count != 1:
+        log.error(f"Product slide count error: expected 1, got {product_count}")
+        raise GeminiServiceError(f"Expected exactly 1 product slide, got {product_count}")
+
+    # Local sanity check: shopping signals belong on the product slide only
+    signal_index, signals = _detect_competitor_signals([
+        '' if slide.get('slide_type') == 'product' else slide.get('text_content', '')
+        for slide in analysis['new_slides']
+    ])
+    if signals:
+        log.warning(f"Shopping signals outside product slide (last at slide {signal_index}): {signals}")
+
+    return analysis
+
+
+def _write_analysis_json(output_dir: str, analysis: dict) -> str:
+    """Save analysis.json to output_dir (one serialize, one write) and return its path"""
+    analysis_path = os.path.join(output_dir, 'analysis.json')
+    data = _dump_json(analysis)
+    try:
+        f = open(analysis_path, 'wb')
+    except FileNotFoundError:
+        # Only pay for makedirs when the directory is actually missing
+        os.makedirs(output_dir, exist_ok=True)
+        f = open(analysis_path, 'wb')
+    with f:
+        f.write(data)
+    return analysis_path
 
-    # Add all slideshow images
-    for i, path in enumerate(slide_paths):
-        contents.append(f"[SLIDE {i}]")
-        contents.append(types.Part.from_bytes(
-            data=_load_image_bytes(path),
-            mime_type=_get_image_mime_type(path)
-        ))
-
-    # Add user's product image last
-    contents.append("[USER'S PRODUCT IMAGE]")
-    contents.append(types.Part.from_bytes(
-        data=_load_image_bytes(product_image_path),
-        mime_type=_get_image_mime_type(product_image_path)
-    ))
+
+def _is_transient_error(error: Exception) -> bool:
+    """True for API errors worth retrying on the same client (5xx, 429)"""
+    if isinstance(error, genai_errors.ServerError):
+        return True
+    return isinstance(error, genai_errors.ClientError) and getattr(error, 'code', None) == 429
+
+
+# Rate-limit errors carry the server's suggested delay, e.g. "Please retry in 12.5s"
+_RETRY_DELAY_PATTERN = re.compile(r'retry in (\d+\.?\d*)s')
+MAX_RETRY_WAIT = 60  # seconds
+
+
+def _retry_wait_time(error: Exception, attempt: int) -> float:
+    """
+    Server-suggested retry delay when present, otherwise full-jitter backoff.
+
+    Jitter keeps workers that failed together (e.g. one burst of 429s) from
+    retrying in lockstep and tripping the limit again.
+    """
+    match = _RETRY_DELAY_PATTERN.search(str(error))
+    if match:
+        return min(float(match.group(1)), MAX_RETRY_WAIT) + random.uniform(0, 1)
+    return random.uniform(1, min(MAX_RETRY_WAIT, 2 ** (attempt + 2)))
+
+
+def _call_analysis_model(client, contents: list, log):
+    """
+    Call the analysis model, retrying transient errors with backoff.
+
+    Retries reuse the same client (and its connection pool) and the already
+    built contents; response validation stays with the caller so a bad JSON
+    answer does not consume retries.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            return client.models.generate_content(
+                model=ANALYSIS_MODEL,
+                contents=contents
+            )
+        except Exception as e:
+            if attempt == MAX_RETRIES - 1 or not _is_transient_error(e):
+                raise
+            wait_time = _retry_wait_time(e, attempt)
+            log.warning(f"Analysis call failed ({e}), retry {attempt + 1}/{MAX_RETRIES - 1} in {wait_time}s")
+            time.sleep(wait_time)
+
+
+def analyze_and_plan(
+    slide_paths: list[str],
+    product_image_path: str,
+    product_description: str,
+    output_dir: str,
+    request_id: str = None
+) -> dict:
+    """
+    Single API call to analyze ALL slides and create new story plan.
+
+    Detects slideshow type, identifies target audience, finds optimal
+    product insertion point, and generates complete slide plan.
+    """
+    log = get_request_logger('gemini', request_id) if request_id else logger
+    log.info(f"Starting analysis: {len(slide_paths)} slides, product: {product_description[:40]}...")
+    start_time = time.time()
+
+    client = _get_client()
+    num_slides = len(slide_paths)
+    contents = _build_analysis_contents(slide_paths, product_image_path, product_description)
 
     try:
-        log.debug(f"Calling {ANALYSIS_MODEL} with {len(contents)} content parts")
-        response = client.models.generate_content(
-            model=ANALYSIS_MODEL,
-            contents=contents
-        )
+        log.debug("Calling %s with %d content parts", ANALYSIS_MODEL, len(contents))
+        response = _call_analysis_model(client, contents, log)
         elapsed = time.time() - start_time
         result_text = response.text
-        log.debug(f"Analysis API response in {elapsed:.1f}s, response length: {len(result_text)}")
+        log.debug("Analysis API response in %.1fs, response length: %d", elapsed, len(result_text))
 
-        # Parse JSON
-        start = result_text.find('{')
-        end = result_text.rfind('}') + 1
-        if start >= 0 and end > start:
-            analysis = json.loads(result_text[start:end])
-        else:
-            log.error("No valid JSON in analysis response")
-            raise GeminiServiceError('No valid JSON in response')
-
-        # Validate structure
-        if 'new_slides' not in analysis:
-            log.error("Missing new_slides in analysis")
-            raise GeminiServiceError('Missing new_slides in analysis')
-        if len(analysis['new_slides']) != num_slides:
-            log.error(f"Slide count mismatch: expected {num_slides}, got {len(analysis['new_slides'])}")
-            raise GeminiServiceError(f"Expected {num_slides} slides, got {len(analysis['new_slides'])}")
-
-        # Validate exactly one product slide
-        product_slides = [s for s in analysis['new_slides'] if s.get('slide_type') == 'product']
-        if len(product_slides) != 1:
-            log.error(f"Product slide count error: expected 1, got {len(product_slides)}")
-            raise GeminiServiceError(f"Expected exactly 1 product slide, got {len(product_slides)}")
-
-        # Save analysis.json
-        os.makedirs(output_dir, exist_ok=True)
-        analysis_path = os.path.join(output_dir, 'analysis.json')
-        with open(analysis_path, 'w') as f:
-            json.dump(analysis, f, indent=2)
+        analysis = _parse_analysis_response(result_text, num_slides, log)
+        _write_analysis_json(output_dir, analysis)
 
         slideshow_type = analysis.get('slideshow_type', 'unknown')
-        log.info(f"Analysis complete in {elapsed:.1f}s: type={slideshow_type}, {len(analysis['new_slides'])} slides")
+        log.info("Analysis complete in %.1fs: type=%s, %d slides", elapsed, slideshow_type, len(analysis['new_slides']))
         return analysis
 
     except json.JSONDecodeError as e:
@@ -476,49 +920,80 @@ CRITICAL RULES:
         raise GeminiServiceError(f'Analysis failed: {str(e)}')
 
 
-def _generate_single_image(
-    client,
-    slide_type: str,
-    scene_description: str,
-    text_content: str,
-    text_position_hint: str,
-    output_path: str,
-    reference_image_path: str,
-    product_image_path: Optional[str] = None,
-    persona_reference_path: Optional[str] = None,
-    has_persona: bool = False,
-    text_style: Optional[dict] = None
-) -> str:
-    """
-    Generate a single image with clear image labeling.
+# Static prompt blocks for image generation (shared by every call)
+DEFAULT_TEXT_STYLE_INSTRUCTION = "Use clean, bold, white sans-serif text with subtle shadow."
 
-    Image roles:
-    - STYLE_REFERENCE: Visual reference for composition, mood, lighting
-    - PERSONA_REFERENCE: Use this person's appearance for consistency
-    - PRODUCT_PHOTO: User's product image (base for product slides)
+PERSONA_CONSISTENCY_INSTRUCTION = """[PERSONA_REFERENCE] - Person to use. Generate the EXACT SAME PERSON in a new scene:
+- SAME face, hair color, skin tone, facial features
+- SAME body type and general appearance
+- DIFFERENT clothing appropriate for this scene context
+- The outfit should match the situation (casual at home, dressed for going out, workout clothes for gym, etc.)
+- This must look like the same creator, just in different clothes"""
 
-    Text style is passed explicitly via text_style dict for accurate font matching.
-    """
+NEW_PERSONA_INSTRUCTION = """CREATE A NEW PERSONA:
+- Attractive, relatable TikTok content creator
+- Natural, authentic appearance
+- Clothing appropriate for this scene context
+- Will be used as reference for other slides"""
 
-    # Build text style instruction from analysis
-    if text_style:
-        text_style_instruction = f"""TEXT STYLE REQUIREMENTS (apply these EXACTLY):
-- Font type: {text_style.get('font_type', 'sans-serif')}
-- Font weight: {text_style.get('font_weight', 'bold')}
-- Font color: {text_style.get('font_color', 'white')}
-- Shadow: {text_style.get('shadow', 'none')}
-- Outline: {text_style.get('outline', 'none')}
-- Background box: {text_style.get('background_box', 'none')}
-- Text size: {text_style.get('text_size', 'medium')} relative to image
-- Position: {text_style.get('position_style', 'varies by slide')}
+SINGLE_PERSON_RULE = "IMPORTANT: Only ONE person in the image - never two people!"
+
+
+@lru_cache(maxsize=32)
+def _build_text_style_instruction(
+    font_type: str,
+    font_weight: str,
+    font_color: str,
+    shadow: str,
+    outline: str,
+    background_box: str,
+    text_size: str,
+    position_style: str
+) -> str:
+    """Build the TEXT STYLE block for image prompts (memoized per style)"""
+    return f"""TEXT STYLE REQUIREMENTS (apply these EXACTLY):
+- Font type: {font_type}
+- Font weight: {font_weight}
+- Font color: {font_color}
+- Shadow: {shadow}
+- Outline: {outline}
+- Background box: {background_box}
+- Text size: {text_size} relative to image
+- Position: {position_style}
 
 These text style specifications are CRITICAL - match them precisely!"""
-    else:
-        text_style_instruction = "Use clean, bold, white sans-serif text with subtle shadow."
-    
-    if slide_type == 'product':
-        # PRODUCT SLIDE: User's product photo + style reference
-        prompt = f"""Generate a TikTok slide featuring a product AS A CASUAL TIP.
+
+
+def _get_text_style_instruction(text_style: Optional[dict]) -> str:
+    """Return the text style instruction for a text_style dict from the analysis"""
+    if not text_style:
+        return DEFAULT_TEXT_STYLE_INSTRUCTION
+    # str() keeps the cache key hashable even if the model returns a list/dict
+    return _build_text_style_instruction(
+        str(text_style.get('font_type', 'sans-serif')),
+        str(text_style.get('font_weight', 'bold')),
+        str(text_style.get('font_color', 'white')),
+        str(text_style.get('shadow', 'none')),
+        str(text_style.get('outline', 'none')),
+        str(text_style.get('background_box', 'none')),
+        str(text_style.get('text_size', 'medium')),
+        str(text_style.get('position_style', 'varies by slide'))
+    )
+
+
+# Prompt label for each slide type (body slides are presented as tips)
+SLIDE_LABELS = {
+    'hook': 'HOOK',
+    'body': 'TIP',
+    'product': 'PRODUCT',
+    'cta': 'CTA'
+}
+
+
+# Prompt skeletons per slide kind, assembled once at import time. Static blocks
+# are already inlined; remaining {placeholders} are filled per image.
+IMAGE_PROMPT_TEMPLATES = {
+    'product': """Generate a TikTok slide featuring a product AS A CASUAL TIP.
 
 {text_style_instruction}
 
@@ -532,25 +1007,9 @@ TEXT TO ADD:
 LAYOUT: {text_position_hint}
 Product must remain FULLY VISIBLE.
 
-GOAL: Look like "just another tip" - NOT an advertisement."""
-
-        contents = [
-            prompt,
-            "[PRODUCT_PHOTO]",
-            types.Part.from_bytes(
-                data=_load_image_bytes(product_image_path),
-                mime_type=_get_image_mime_type(product_image_path)
-            ),
-            "[STYLE_REFERENCE]",
-            types.Part.from_bytes(
-                data=_load_image_bytes(reference_image_path),
-                mime_type=_get_image_mime_type(reference_image_path)
-            )
-        ]
-    
-    elif slide_type == 'cta':
-        # CTA SLIDE: Usually text-focused, simple background
-        prompt = f"""Generate a TikTok CTA (call-to-action) slide.
+GOAL: Look like "just another tip" - NOT an advertisement.""",
+
+    'cta': """Generate a TikTok CTA (call-to-action) slide.
 
 {text_style_instruction}
 
@@ -559,148 +1018,311 @@ GOAL: Look like "just another tip" - NOT an advertisement."""
 TEXT TO DISPLAY:
 {text_content}
 
-LAYOUT: {text_position_hint}"""
+LAYOUT: {text_position_hint}""",
 
-        contents = [
-            prompt,
-            "[STYLE_REFERENCE]",
-            types.Part.from_bytes(
-                data=_load_image_bytes(reference_image_path),
-                mime_type=_get_image_mime_type(reference_image_path)
-            )
-        ]
-    
-    else:
-        # HOOK or BODY SLIDE
-        slide_label = "HOOK" if slide_type == "hook" else "TIP"
+    # Hook/body with an existing persona - keep the same person
+    'persona': f"""Generate a TikTok {{slide_label}} slide.
 
-        if has_persona and persona_reference_path:
-            # With persona - need consistency
-            prompt = f"""Generate a TikTok {slide_label} slide.
-
-{text_style_instruction}
+{{text_style_instruction}}
 
 [STYLE_REFERENCE] - Reference slide for visual composition and mood.
 
-[PERSONA_REFERENCE] - Person to use. Generate the EXACT SAME PERSON in a new scene:
-- SAME face, hair color, skin tone, facial features
-- SAME body type and general appearance
-- DIFFERENT clothing appropriate for this scene context
-- The outfit should match the situation (casual at home, dressed for going out, workout clothes for gym, etc.)
-- This must look like the same creator, just in different clothes
+{PERSONA_CONSISTENCY_INSTRUCTION}
 
-NEW SCENE: {scene_description}
+NEW SCENE: {{scene_description}}
 
 TEXT TO DISPLAY:
-{text_content}
+{{text_content}}
 
-LAYOUT: {text_position_hint}
+LAYOUT: {{text_position_hint}}
 Never cover face with text
 
-IMPORTANT: Only ONE person in the image - never two people!"""
-
-            contents = [
-                prompt,
-                "[STYLE_REFERENCE]",
-                types.Part.from_bytes(
-                    data=_load_image_bytes(reference_image_path),
-                    mime_type=_get_image_mime_type(reference_image_path)
-                ),
-                "[PERSONA_REFERENCE]",
-                types.Part.from_bytes(
-                    data=_load_image_bytes(persona_reference_path),
-                    mime_type=_get_image_mime_type(persona_reference_path)
-                )
-            ]
-        elif has_persona:
-            # Has persona but NO reference yet - CREATE a new persona
-            prompt = f"""Generate a TikTok {slide_label} slide.
+{SINGLE_PERSON_RULE}""",
 
-{text_style_instruction}
+    # Hook/body that needs a persona but has no reference yet - create one
+    'new_persona': f"""Generate a TikTok {{slide_label}} slide.
+
+{{text_style_instruction}}
 
 [STYLE_REFERENCE] - Reference slide for visual composition and mood.
 (Do NOT copy the person - create a NEW person)
 
-CREATE A NEW PERSONA:
-- Attractive, relatable TikTok content creator
-- Natural, authentic appearance
-- Clothing appropriate for this scene context
-- Will be used as reference for other slides
+{NEW_PERSONA_INSTRUCTION}
 
-NEW SCENE: {scene_description}
+NEW SCENE: {{scene_description}}
 
 TEXT TO DISPLAY:
-{text_content}
+{{text_content}}
 
-LAYOUT: {text_position_hint}
+LAYOUT: {{text_position_hint}}
 Never cover face with text
 
-IMPORTANT: Only ONE person in the image - never two people!"""
+{SINGLE_PERSON_RULE}""",
 
-            contents = [
-                prompt,
-                "[STYLE_REFERENCE]",
-                types.Part.from_bytes(
-                    data=_load_image_bytes(reference_image_path),
-                    mime_type=_get_image_mime_type(reference_image_path)
-                )
-            ]
-        else:
-            # No persona needed - just style reference
-            prompt = f"""Generate a TikTok {slide_label} slide.
+    # Hook/body without a persona - style reference only
+    'scene': f"""Generate a TikTok {{slide_label}} slide.
 
-{text_style_instruction}
+{{text_style_instruction}}
 
 [STYLE_REFERENCE] - Reference slide for visual composition and mood.
 
-NEW SCENE: {scene_description}
+NEW SCENE: {{scene_description}}
 
 TEXT TO DISPLAY:
-{text_content}
+{{text_content}}
 
-LAYOUT: {text_position_hint}
+LAYOUT: {{text_position_hint}}
 
-IMPORTANT: Only ONE person in the image - never two people!"""
+{SINGLE_PERSON_RULE}"""
+}
+
+
+def _build_image_prompt(
+    slide_type: str,
+    scene_description: str,
+    text_content: str,
+    text_position_hint: str,
+    reference_image_path: str,
+    product_image_path: Optional[str] = None,
+    persona_reference_path: Optional[str] = None,
+    has_persona: bool = False,
+    text_style: Optional[dict] = None
+) -> tuple[str, list[tuple[str, str, bool]]]:
+    """
+    Assemble the prompt and image layout for a single image generation.
+
+    Image roles:
+    - STYLE_REFERENCE: Visual reference for composition, mood, lighting
+    - PERSONA_REFERENCE: Use this person's appearance for consistency
+    - PRODUCT_PHOTO: User's product image (base for product slides)
+
+    Text style is passed explicitly via text_style dict for accurate font matching.
+
+    Returns:
+        (prompt text, [(label, image path, downscale), ...]) - nothing is
+        read or uploaded yet, so this is cheap enough to feed the cache key
+    """
+    if slide_type == 'product':
+        # PRODUCT SLIDE: User's product photo + style reference
+        template_key = 'product'
+        image_inputs = [
+            ("[PRODUCT_PHOTO]", product_image_path, False),
+            ("[STYLE_REFERENCE]", reference_image_path, True)
+        ]
+    elif slide_type == 'cta':
+        # CTA SLIDE: Usually text-focused, simple background
+        template_key = 'cta'
+        image_inputs = [("[STYLE_REFERENCE]", reference_image_path, True)]
+    elif has_persona and persona_reference_path:
+        # HOOK/BODY with persona - need consistency
+        template_key = 'persona'
+        image_inputs = [
+            ("[STYLE_REFERENCE]", reference_image_path, True),
+            ("[PERSONA_REFERENCE]", persona_reference_path, True)
+        ]
+    else:
+        # HOOK/BODY creating a new persona, or no persona needed
+        template_key = 'new_persona' if has_persona else 'scene'
+        image_inputs = [("[STYLE_REFERENCE]", reference_image_path, True)]
+
+    prompt = IMAGE_PROMPT_TEMPLATES[template_key].format(
+        slide_label=SLIDE_LABELS.get(slide_type, 'TIP'),
+        # Cached - same style for every slide
+        text_style_instruction=_get_text_style_instruction(text_style),
+        scene_description=scene_description,
+        text_content=text_content,
+        text_position_hint=text_position_hint
+    )
+    return prompt, image_inputs
+
+
+def _build_image_contents(prompt: str, image_inputs: list[tuple[str, str, bool]]) -> list:
+    """Prompt + labeled image parts (Files API handles or inline bytes) for a generation call"""
+    contents = [prompt]
+    for label, image_path, downscale in image_inputs:
+        contents.append(label)
+        contents.append(_reference_image_part(image_path, downscale))
+    return contents
+
+
+# Image generation settings (same for every slide)
+IMAGE_GENERATION_CONFIG = types.GenerateContentConfig(
+    response_modalities=['image', 'text'],
+    image_config=types.ImageConfig(
+        aspect_ratio="9:16",
+        image_size="4K"  # 4096px for better text quality
+    )
+)
 
-            contents = [
-                prompt,
-                "[STYLE_REFERENCE]",
-                types.Part.from_bytes(
-                    data=_load_image_bytes(reference_image_path),
-                    mime_type=_get_image_mime_type(reference_image_path)
-                )
-            ]
 
-    # Retry logic
+def _save_generated_image(response, output_path: str) -> str:
+    """Write the first inline image of a generation response to output_path"""
+    for part in response.parts:
+        if hasattr(part, 'inline_data') and part.inline_data:
+            with open(output_path, 'wb') as f:
+                f.write(part.inline_data.data)
+            return output_path
+
+    raise GeminiServiceError('No image in response')
+
+
+def _generated_image_cache_key(
+    prompt: str,
+    image_inputs: list[tuple[str, str, bool]],
+    variation: int
+) -> str:
+    """
+    sha256 over model settings, the assembled prompt, reference preprocessing,
+    variation number and input image bytes.
+
+    Hashing the final prompt text means any template/instruction change
+    invalidates old entries; reference size/quality/encoder cover how the
+    downscaled inputs are produced.
+    """
+    digest = hashlib.sha256(repr((
+        IMAGE_MODEL,
+        IMAGE_GENERATION_CONFIG.image_config.aspect_ratio,
+        IMAGE_GENERATION_CONFIG.image_config.image_size,
+        REFERENCE_IMAGE_SIZE, REFERENCE_JPEG_QUALITY, USE_PYVIPS, USE_FILES_API,
+        prompt,
+        [(label, downscale) for label, _, downscale in image_inputs],
+        variation
+    )).encode('utf-8'))
+    for _, path, _ in image_inputs:
+        digest.update(b'\0')
+        digest.update(_load_image(path)[0])
+    return digest.hexdigest()
+
+
+def _generated_cache_path(cache_key: str) -> str:
+    """Location of a cached generated image (sharded by key prefix)"""
+    return os.path.join(GENERATED_CACHE_DIR, cache_key[:2], f'{cache_key}.png')
+
+
+def _restore_cached_image(cache_key: str, output_path: str) -> bool:
+    """Copy a cached image to output_path; returns False on a cache miss"""
+    cached_path = _generated_cache_path(cache_key)
+    try:
+        shutil.copyfile(cached_path, output_path)
+    except FileNotFoundError:
+        return False
+    try:
+        os.utime(cached_path)  # mark as recently used for pruning
+    except FileNotFoundError:
+        pass  # pruned by another job after the copy - output_path is still complete
+    return True
+
+
+def _store_cached_image(cache_key: str, output_path: str) -> None:
+    """Save a freshly generated image into the cache (best effort)"""
+    cached_path = _generated_cache_path(cache_key)
+    temp_path = None
+    try:
+        shard_dir = os.path.dirname(cached_path)
+        os.makedirs(shard_dir, exist_ok=True)
+        # Unique temp name in the same directory, safe across threads and processes
+        fd, temp_path = tempfile.mkstemp(dir=shard_dir, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(output_path, temp_path)
+        os.replace(temp_path, cached_path)  # atomic - readers never see partial files
+    except OSError as e:
+        logger.warning(f"Could not cache generated image: {e}")
+        if temp_path:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
+def _prune_generated_cache() -> None:
+    """Evict least recently used cached images beyond GENERATED_CACHE_MAX_BYTES"""
+    entries = []
+    for root, _, files in os.walk(GENERATED_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    if total_bytes <= GENERATED_CACHE_MAX_BYTES:
+        return
+
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        if total_bytes <= GENERATED_CACHE_MAX_BYTES:
+            break
+    logger.info(f"Pruned generated image cache to {total_bytes / 1024 / 1024:.0f}MB")
+
+
+async def _generate_single_image(
+    client,
+    slide_type: str,
+    scene_description: str,
+    text_content: str,
+    text_position_hint: str,
+    output_path: str,
+    reference_image_path: str,
+    product_image_path: Optional[str] = None,
+    persona_reference_path: Optional[str] = None,
+    has_persona: bool = False,
+    text_style: Optional[dict] = None,
+    variation: int = 1,
+    rate_limiter: Optional[AsyncRateLimiter] = None
+) -> str:
+    """
+    Generate a single image with clear image labeling (client is client.aio).
+
+    See _build_image_prompt() for the image roles sent with the prompt.
+    Results are served from / stored in the persistent generated-image cache;
+    variation is part of the cache key so each version stays distinct.
+    The rate limiter is held per API attempt only - never during backoff
+    or for cache hits - so retrying tasks don't block queued ones. Image
+    reads, cache access and the output write run in worker threads.
+    """
+    prompt, image_inputs = _build_image_prompt(
+        slide_type, scene_description, text_content, text_position_hint,
+        reference_image_path, product_image_path, persona_reference_path,
+        has_persona, text_style
+    )
+    if USE_GENERATED_CACHE:
+        cache_key = await asyncio.to_thread(_generated_image_cache_key, prompt, image_inputs, variation)
+        if await asyncio.to_thread(_restore_cached_image, cache_key, output_path):
+            logger.debug("Generated image cache hit: %s", output_path)
+            return output_path
+
+    contents = await asyncio.to_thread(_build_image_contents, prompt, image_inputs)
+
     last_error = None
     for attempt in range(MAX_RETRIES):
         try:
-            response = client.models.generate_content(
-                model=IMAGE_MODEL,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    response_modalities=['image', 'text'],
-                    image_config=types.ImageConfig(
-                        aspect_ratio="9:16",
-                        image_size="4K"  # 4096px for better text quality
-                    )
+            if rate_limiter:
+                await rate_limiter.acquire()
+            try:
+                response = await client.models.generate_content(
+                    model=IMAGE_MODEL,
+                    contents=contents,
+                    config=IMAGE_GENERATION_CONFIG
                 )
-            )
-
-            # Extract generated image
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    with open(output_path, 'wb') as f:
-                        f.write(part.inline_data.data)
-                    return output_path
-
-            raise GeminiServiceError('No image in response')
+            finally:
+                if rate_limiter:
+                    rate_limiter.release()
+            await asyncio.to_thread(_save_generated_image, response, output_path)
+            if USE_GENERATED_CACHE:
+                await asyncio.to_thread(_store_cached_image, cache_key, output_path)
+            return output_path
 
         except Exception as e:
             last_error = e
             if attempt < MAX_RETRIES - 1:
-                wait_time = (2 ** attempt) + 1
-                time.sleep(wait_time)
+                wait_time = _retry_wait_time(e, attempt)
+                await asyncio.sleep(wait_time)
 
     raise GeminiServiceError(f'Failed after {MAX_RETRIES} retries: {last_error}')
 
@@ -713,53 +1335,31 @@ ImageProgressCallback = Callable[[int, int, str], None]
 PipelineProgressCallback = Callable[[str, str, int], None]
 
 
-def generate_all_images(
-    analysis: dict,
+def _build_generation_tasks(
+    new_slides: list[dict],
     slide_paths: list[str],
     product_image_path: str,
     output_dir: str,
-    progress_callback: Optional[ImageProgressCallback] = None,
     hook_variations: int = 1,
     body_variations: int = 1,
-    product_variations: int = 1,
-    request_id: str = None
-) -> dict:
+    product_variations: int = 1
+) -> tuple[list[dict], dict]:
     """
-    Generate all images with persona consistency and variations support.
-
-    Strategy:
-    1. Generate first persona variation FIRST (creates the persona)
-    2. Use that generated image as PERSONA_REFERENCE for all other persona slides/variations
-    3. Run all remaining variations in parallel
-
-    Args:
-        analysis: Output from analyze_and_plan()
-        slide_paths: List of original slide image paths
-        product_image_path: Path to user's product image
-        output_dir: Directory to save generated images
-        progress_callback: Optional callback with signature (current, total, message)
-        hook_variations: Number of variations for hook slide (default 1)
-        body_variations: Number of variations per body slide (default 1)
-        product_variations: Number of variations for product slide (default 1)
-        request_id: Optional request ID for logging
+    Expand the slide plan into one generation task per variation.
 
     Returns:
-        dict with:
-            - images: flat list of all generated image paths
-            - variations: structured dict by slide type
+        (all_tasks, variations_structure) - variations_structure maps each
+        slide key to an empty list that is filled with output paths later
     """
-    log = get_request_logger('gemini', request_id) if request_id else logger
-    start_time = time.time()
-
-    client = _get_client()
-    os.makedirs(output_dir, exist_ok=True)
-
-    new_slides = analysis['new_slides']
-    text_style = analysis.get('text_style', None)  # Extract text style from analysis
-
-    # Build all tasks with variations
     all_tasks = []
     variations_structure = {}  # Track variations by slide key
+    out_prefix = os.path.join(output_dir, '')  # joined once, f-strings per task
+
+    # Body slides are numbered in plan order (body_1, body_2, ...)
+    body_numbers = {}
+    for slide in new_slides:
+        if slide['slide_type'] == 'body':
+            body_numbers[slide['slide_index']] = len(body_numbers) + 1
 
     for slide in new_slides:
         idx = slide['slide_index']
@@ -779,12 +1379,17 @@ def generate_all_images(
             slide_key = 'cta'
         else:  # body
             num_variations = body_variations
-            body_num = sum(1 for s in new_slides[:idx] if s['slide_type'] == 'body') + 1
-            slide_key = f'body_{body_num}'
+            slide_key = f'body_{body_numbers[idx]}'
 
         # Initialize variations list for this slide
-        if slide_key not in variations_structure:
-            variations_structure[slide_key] = []
+        variations_structure.setdefault(slide_key, [])
+
+        # Per-slide inputs shared by every variation
+        reference_image_path = slide_paths[ref_idx] if ref_idx < len(slide_paths) else slide_paths[0]
+        scene_description = slide.get('new_scene_description', '')
+        text_content = slide.get('text_content', '')
+        text_position_hint = slide.get('text_position_hint', '')
+        slide_product_path = product_image_path if slide_type == 'product' else None
 
         # Create task for each variation
         for v in range(num_variations):
@@ -792,9 +1397,9 @@ def generate_all_images(
 
             # Determine output filename with version
             if slide_type == 'cta':
-                output_path = os.path.join(output_dir, 'cta.png')
+                output_path = f'{out_prefix}cta.png'
             else:
-                output_path = os.path.join(output_dir, f'{slide_key}_v{version}.png')
+                output_path = f'{out_prefix}{slide_key}_v{version}.png'
 
             task = {
                 'task_id': f'{slide_key}_v{version}',
@@ -802,133 +1407,470 @@ def generate_all_images(
                 'slide_type': slide_type,
                 'slide_key': slide_key,
                 'version': version,
-                'reference_image_path': slide_paths[ref_idx] if ref_idx < len(slide_paths) else slide_paths[0],
-                'scene_description': slide.get('new_scene_description', ''),
-                'text_content': slide.get('text_content', ''),
-                'text_position_hint': slide.get('text_position_hint', ''),
+                'reference_image_path': reference_image_path,
+                'scene_description': scene_description,
+                'text_content': text_content,
+                'text_position_hint': text_position_hint,
                 'output_path': output_path,
-                'product_image_path': product_image_path if slide_type == 'product' else None,
+                'product_image_path': slide_product_path,
                 'has_persona': has_persona
             }
             all_tasks.append(task)
 
-    total = len(all_tasks)
+    return all_tasks, variations_structure
 
-    # Separate persona tasks from non-persona tasks
-    persona_tasks = [t for t in all_tasks if t['has_persona']]
-    non_persona_tasks = [t for t in all_tasks if not t['has_persona']]
 
-    log.info(f"Generation tasks: {total} total ({len(persona_tasks)} persona, {len(non_persona_tasks)} non-persona)")
+def _dedupe_generation_tasks(tasks: list[dict]) -> tuple[list[dict], dict]:
+    """
+    Split tasks into unique ones and exact duplicates.
 
-    # Initialize rate limiter
-    rate_limiter = RateLimiter(rpm=RPM_LIMIT, max_concurrent=MAX_CONCURRENT)
+    Two tasks are duplicates when every generation input and the version
+    match, so intended variations (different versions) are never merged.
 
-    results = {}  # task_id -> output_path
-    errors = []
-    completed = 0
+    Returns:
+        (unique_tasks, duplicates) - duplicates maps a primary task_id to the
+        tasks that should receive a copy of its output
+    """
+    unique_tasks = []
+    duplicates = {}
+    primary_by_key = {}
+    for task in tasks:
+        key = (
+            task['slide_type'], task['scene_description'], task['text_content'],
+            task['text_position_hint'], task['reference_image_path'],
+            task['product_image_path'], task['has_persona'], task['version']
+        )
+        primary = primary_by_key.get(key)
+        if primary is None:
+            primary_by_key[key] = task
+            unique_tasks.append(task)
+        else:
+            duplicates.setdefault(primary['task_id'], []).append(task)
+    return unique_tasks, duplicates
+
+
+def _split_persona_tasks(tasks: list[dict]) -> tuple[list[dict], list[dict]]:
+    """Split tasks into (persona, non-persona) in one pass, keeping task order"""
+    groups = ([], [])
+    for task in tasks:
+        groups[not task['has_persona']].append(task)
+    return groups
+
+
+def _copy_duplicate_results(duplicates: dict, results: dict) -> None:
+    """Copy each generated primary image to its duplicate tasks' output paths"""
+    for primary_id, duplicate_tasks in duplicates.items():
+        if primary_id not in results:
+            continue  # primary failed - already reported as an error
+        for task in duplicate_tasks:
+            shutil.copyfile(results[primary_id], task['output_path'])
+            results[task['task_id']] = task['output_path']
+
+
+def _collect_generation_results(
+    all_tasks: list[dict],
+    results: dict,
+    errors: list,
+    variations_structure: dict,
+    log
+) -> dict:
+    """
+    Raise if any task failed, otherwise order outputs by task.
 
-    def generate_task(task, persona_ref_path=None):
-        """Generate single image with rate limiting."""
+    Returns:
+        dict with images (flat list in task order) and variations (by slide key)
+    """
+    if errors:
+        log.error(f"Generation failed: {len(errors)} errors")
+        for task_id, err in errors:
+            log.error(f"  {task_id}: {err}")
+        error_msgs = [f"{task_id}: {err}" for task_id, err in errors]
+        raise GeminiServiceError(f"Image generation failed:\n" + "\n".join(error_msgs))
+
+    # Build flat list (all images in task order) and variations structure in one pass
+    all_images = []
+    for task in all_tasks:
+        output_path = results.get(task['task_id'])
+        if output_path is not None:
+            all_images.append(output_path)
+            variations_structure[task['slide_key']].append(output_path)
+
+    return {
+        'images': all_images,
+        'variations': variations_structure
+    }
+
+
+def _generate_images_batch(client, tasks: list[tuple], text_style: Optional[dict], log) -> dict:
+    """
+    Generate tasks through a single Gemini batch prediction job.
+
+    Cache hits are restored locally and never submitted. Blocks until the
+    job finishes, polling with a backoff from BATCH_MIN_POLL_INTERVAL up to
+    BATCH_POLL_INTERVAL seconds.
+
+    Args:
+        client: Gemini client
+        tasks: List of (task, persona_ref_path) pairs
+        text_style: Text style from analysis
+        log: Logger
+
+    Returns:
+        dict of task_id -> output_path, or the Exception for tasks the batch
+        did not produce (callers retry those with online requests)
+    """
+    outcomes = {}
+    pending = []  # (task, cache_key) in request order
+    inlined_requests = []
+
+    for task, persona_ref_path in tasks:
+        prompt, image_inputs = _build_image_prompt(
+            task['slide_type'], task['scene_description'], task['text_content'],
+            task['text_position_hint'], task['reference_image_path'],
+            task['product_image_path'], persona_ref_path, task['has_persona'], text_style
+        )
+        cache_key = None
+        if USE_GENERATED_CACHE:
+            cache_key = _generated_image_cache_key(prompt, image_inputs, task['version'])
+            if _restore_cached_image(cache_key, task['output_path']):
+                outcomes[task['task_id']] = task['output_path']
+                continue
+
+        contents = _build_image_contents(prompt, image_inputs)
+        inlined_requests.append(types.InlinedRequest(contents=contents, config=IMAGE_GENERATION_CONFIG))
+        pending.append((task, cache_key))
+
+    if not pending:
+        return outcomes
+
+    job = client.batches.create(
+        model=IMAGE_MODEL,
+        src=inlined_requests,
+        config={'display_name': f'slideshow-images-{int(time.time())}'}
+    )
+    log.info(f"Submitted batch job {job.name} with {len(pending)} image requests")
+
+    deadline = time.time() + BATCH_TIMEOUT
+    poll_interval = BATCH_MIN_POLL_INTERVAL
+    while job.state.name not in BATCH_DONE_STATES:
+        if time.time() > deadline:
+            client.batches.cancel(name=job.name)
+            break
+        time.sleep(poll_interval)
+        previous_state = job.state.name
+        job = client.batches.get(name=job.name)
+        # Poll quickly again after a state change, back off while nothing happens
+        if job.state.name != previous_state:
+            poll_interval = BATCH_MIN_POLL_INTERVAL
+        else:
+            poll_interval = min(poll_interval * 1.5, BATCH_POLL_INTERVAL)
+
+    if job.state.name != 'JOB_STATE_SUCCEEDED':
+        error = GeminiServiceError(f'Batch job {job.name} ended in state {job.state.name}')
+        for task, _ in pending:
+            outcomes[task['task_id']] = error
+        return outcomes
+
+    # Inlined responses come back in request order
+    for (task, cache_key), inlined in zip(pending, job.dest.inlined_responses):
         try:
-            rate_limiter.acquire()
-            try:
-                return task['task_id'], _generate_single_image(
-                    client,
-                    task['slide_type'],
-                    task['scene_description'],
-                    task['text_content'],
-                    task['text_position_hint'],
-                    task['output_path'],
-                    task['reference_image_path'],
-                    task['product_image_path'],
-                    persona_ref_path,
-                    task['has_persona'],
-                    text_style  # Pass text style from analysis
-                )
-            finally:
-                rate_limiter.release()
-        except GeminiServiceError as e:
-            return task['task_id'], e
+            if inlined.error:
+                raise GeminiServiceError(f'Batch request failed: {inlined.error}')
+            _save_generated_image(inlined.response, task['output_path'])
+            if cache_key:
+                _store_cached_image(cache_key, task['output_path'])
+            outcomes[task['task_id']] = task['output_path']
         except Exception as e:
-            return task['task_id'], GeminiServiceError(f'Unexpected error: {e}')
+            outcomes[task['task_id']] = e
 
-    # STEP 1: Generate FIRST persona variation sequentially (creates the persona)
-    generated_persona_path = None
-    if persona_tasks:
-        first_persona_task = persona_tasks[0]
-        remaining_persona_tasks = persona_tasks[1:]
+    return outcomes
 
-        if progress_callback:
-            progress_callback(0, total, 'Creating persona (first variation)...')
 
-        # Generate first persona - no reference, creates NEW persona
-        task_id, result = generate_task(first_persona_task, persona_ref_path=None)
-        completed += 1
+async def generate_all_images_async(
+    analysis: dict,
+    slide_paths: list[str],
+    product_image_path: str,
+    output_dir: str,
+    progress_callback: Optional[ImageProgressCallback] = None,
+    hook_variations: int = 1,
+    body_variations: int = 1,
+    product_variations: int = 1,
+    request_id: str = None,
+    use_batch_api: bool = USE_BATCH_API
+) -> dict:
+    """
+    Generate all images with persona consistency and variations support.
 
-        if isinstance(result, Exception):
-            errors.append((task_id, result))
-        else:
-            results[task_id] = result
-            generated_persona_path = result  # Use THIS for all other persona variations
+    Strategy:
+    1. Generate first persona variation (creates the persona) while all
+       non-persona variations already run in parallel
+    2. Use that generated image as PERSONA_REFERENCE for all other persona slides/variations,
+       started as soon as it exists
+    3. With use_batch_api, each wave after the persona goes out as one batch
+       job; failed batch requests fall back to online calls
 
-        if progress_callback:
-            progress_callback(completed, total, f'Persona created! Generating {total - 1} more...')
-    else:
-        remaining_persona_tasks = []
+    Online calls run on one event loop via client.aio: MAX_CONCURRENT workers
+    drain a bounded work queue, so only that many requests are in flight,
+    paced by an AsyncRateLimiter. Batch jobs block while polling and run in a thread.
 
-    # STEP 2: Generate all remaining in parallel
-    remaining_tasks = []
+    Args:
+        analysis: Output from analyze_and_plan()
+        slide_paths: List of original slide image paths
+        product_image_path: Path to user's product image
+        output_dir: Directory to save generated images
+        progress_callback: Optional callback with signature (current, total, message)
+        hook_variations: Number of variations for hook slide (default 1)
+        body_variations: Number of variations per body slide (default 1)
+        product_variations: Number of variations for product slide (default 1)
+        request_id: Optional request ID for logging
+        use_batch_api: Use the batch prediction endpoint for the remaining
+            variations - cheaper, but progress is only reported when it ends
 
-    for task in remaining_persona_tasks:
-        remaining_tasks.append((task, generated_persona_path))
+    Returns:
+        dict with:
+            - images: flat list of all generated image paths
+            - variations: structured dict by slide type
+    """
+    log = get_request_logger('gemini', request_id) if request_id else logger
+    start_time = time.time()
 
-    for task in non_persona_tasks:
-        remaining_tasks.append((task, None))
+    os.makedirs(output_dir, exist_ok=True)
 
-    if remaining_tasks:
-        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT) as executor:
-            futures = {
-                executor.submit(generate_task, task, persona_ref): task
-                for task, persona_ref in remaining_tasks
-            }
+    new_slides = analysis['new_slides']
+    text_style = analysis.get('text_style', None)  # Extract text style from analysis
 
-            for future in as_completed(futures):
-                task_id, result = future.result()
-                completed += 1
+    # Build all tasks with variations
+    all_tasks, variations_structure = _build_generation_tasks(
+        new_slides, slide_paths, product_image_path, output_dir,
+        hook_variations, body_variations, product_variations
+    )
 
-                if isinstance(result, Exception):
-                    errors.append((task_id, result))
-                else:
-                    results[task_id] = result
+    # Identical tasks (same inputs and version) are generated once and copied
+    unique_tasks, duplicate_tasks = _dedupe_generation_tasks(all_tasks)
+    total = len(unique_tasks)
 
-                if progress_callback:
-                    progress_callback(completed, total, f'Generated {completed}/{total} variations')
+    # Separate persona tasks from non-persona tasks
+    persona_tasks, non_persona_tasks = _split_persona_tasks(unique_tasks)
 
-    # Check for errors
-    if errors:
-        log.error(f"Generation failed: {len(errors)} errors")
-        for task_id, err in errors:
-            log.error(f"  {task_id}: {err}")
-        error_msgs = [f"{task_id}: {err}" for task_id, err in errors]
-        raise GeminiServiceError(f"Image generation failed:\n" + "\n".join(error_msgs))
+    log.info(f"Generation tasks: {total} total ({len(persona_tasks)} persona, {len(non_persona_tasks)} non-persona, {len(all_tasks) - total} duplicates)")
 
-    # Build variations structure with actual paths
-    for task in all_tasks:
-        task_id = task['task_id']
-        slide_key = task['slide_key']
-        if task_id in results:
-            variations_structure[slide_key].append(results[task_id])
+    if not unique_tasks:
+        # Nothing to generate - skip cache pruning, prefetch and the workers
+        return _collect_generation_results(all_tasks, {}, [], variations_structure, log)
 
-    # Build flat list (all images in task order)
-    all_images = [results[t['task_id']] for t in all_tasks if t['task_id'] in results]
+    if USE_GENERATED_CACHE:
+        await asyncio.to_thread(_prune_generated_cache)
+
+    # Prepare every style reference up front, in parallel
+    await asyncio.to_thread(
+        _prefetch_reference_images, [t['reference_image_path'] for t in all_tasks]
+    )
+
+    # Per-job client: its async connection pool is bound to this event loop
+    job_client = _create_client()
+    try:
+        results, errors = await _run_generation_tasks(
+            job_client.aio, persona_tasks, non_persona_tasks, text_style,
+            progress_callback, use_batch_api, log
+        )
+    finally:
+        await job_client.aio.aclose()
+        job_client.close()
+        # The generated persona reference is only reused within this job
+        _forget_uploaded_files(output_dir)
+
+    _copy_duplicate_results(duplicate_tasks, results)
+    generation_result = _collect_generation_results(all_tasks, results, errors, variations_structure, log)
 
     elapsed = time.time() - start_time
-    log.info(f"All images generated in {elapsed:.1f}s: {len(all_images)} images")
+    log.info(f"All images generated in {elapsed:.1f}s: {len(generation_result['images'])} images")
 
-    return {
-        'images': all_images,
-        'variations': variations_structure
-    }
+    return generation_result
+
+
+async def _run_generation_tasks(
+    client,
+    persona_tasks: list[dict],
+    non_persona_tasks: list[dict],
+    text_style: Optional[dict],
+    progress_callback: Optional[ImageProgressCallback],
+    use_batch_api: bool,
+    log
+) -> tuple[dict, list]:
+    """
+    Generate every unique task, persona dependents after the first persona.
+
+    Returns:
+        (results, errors) - task_id -> output_path, and (task_id, error) pairs
+    """
+    total = len(persona_tasks) + len(non_persona_tasks)
+    rate_limiter = AsyncRateLimiter(rpm=RPM_LIMIT, max_concurrent=MAX_CONCURRENT)
+
+    results = {}  # task_id -> output_path
+    errors = []
+    completed = 0
+    progress_step = max(1, total // MAX_PROGRESS_UPDATES)
+    all_done = asyncio.Event()
+    failures = []  # exceptions that killed a worker, feeder or batch job
+
+    # Online (task, persona_ref) pairs. Feeders await put() once it is full, so
+    # only O(MAX_CONCURRENT) pairs wait while MAX_CONCURRENT workers drain it
+    queue = asyncio.Queue(maxsize=MAX_CONCURRENT * 2)
+    runs = set()  # running batch jobs and queue feeders
+    first_persona_id = persona_tasks[0]['task_id'] if persona_tasks else None
+
+    def record(task_id, result, message=None):
+        """Store one finished task and report progress."""
+        nonlocal completed
+        completed += 1
+        if isinstance(result, Exception):
+            errors.append((task_id, result))
+        else:
+            results[task_id] = result
+        if completed == total:
+            all_done.set()
+        if progress_callback and (message or completed % progress_step == 0 or completed == total):
+            progress_callback(completed, total, message or f'Generated {completed}/{total} variations')
+
+    def finished(run):
+        """Done callback: wake the wait below if a worker, feeder or batch job raised."""
+        runs.discard(run)
+        if not run.cancelled() and run.exception() is not None:
+            failures.append(run.exception())
+            all_done.set()
+
+    def start(coro):
+        """Run coro as a watched background task."""
+        run = asyncio.create_task(coro)
+        run.add_done_callback(finished)
+        runs.add(run)
+
+    async def feed(task_pairs):
+        """Hand pairs to the workers as queue slots free up."""
+        for pair in task_pairs:
+            await queue.put(pair)
+
+    def submit(task_pairs):
+        """Queue (task, persona_ref) pairs as one batch job or as online tasks."""
+        if not task_pairs:
+            return
+        if use_batch_api:
+            start(run_batch(task_pairs))
+            if progress_callback:
+                progress_callback(completed, total, f'Submitted {len(task_pairs)} variations as a batch job...')
+        else:
+            # A separate feeder, so a worker or this loop never blocks on a full queue
+            start(feed(task_pairs))
+
+    async def generate_task(task, persona_ref_path=None):
+        """Generate single image with rate limiting."""
+        try:
+            return task['task_id'], await _generate_single_image(
+                client,
+                task['slide_type'],
+                task['scene_description'],
+                task['text_content'],
+                task['text_position_hint'],
+                task['output_path'],
+                task['reference_image_path'],
+                task['product_image_path'],
+                persona_ref_path,
+                task['has_persona'],
+                text_style,  # Pass text style from analysis
+                task['version'],
+                rate_limiter
+            )
+        except GeminiServiceError as e:
+            return task['task_id'], e
+        except Exception as e:
+            return task['task_id'], GeminiServiceError(f'Unexpected error: {e}')
+
+    async def run_batch(task_pairs):
+        """Run one batch job; anything it did not produce is retried online."""
+        try:
+            # Polling blocks for minutes - keep it off the event loop
+            batch_outcomes = await asyncio.to_thread(
+                _generate_images_batch, _get_client(), task_pairs, text_style, log
+            )
+        except Exception as e:
+            log.warning(f"Batch job failed, falling back to online generation: {e}")
+            batch_outcomes = {}
+
+        retries = []
+        for task, persona_ref in task_pairs:
+            result = batch_outcomes.get(task['task_id'])
+            if isinstance(result, str):
+                record(task['task_id'], result)
+                continue
+            if result is not None:
+                log.warning(f"Batch request {task['task_id']} failed, retrying online: {result}")
+            retries.append((task, persona_ref))
+        await feed(retries)
+
+    async def worker():
+        """Generate queued (task, persona_ref) pairs until cancelled."""
+        while True:
+            task, persona_ref = await queue.get()
+            task_id, result = await generate_task(task, persona_ref)
+            if task_id == first_persona_id:
+                record(task_id, result, f'Persona created! Generated {completed + 1}/{total} variations')
+                # Use THIS image as the reference for all other persona variations
+                generated_persona_path = None if isinstance(result, Exception) else result
+                submit([(dependent, generated_persona_path) for dependent in persona_tasks[1:]])
+            else:
+                record(task_id, result)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(MAX_CONCURRENT, total))]
+    for run in workers:
+        run.add_done_callback(finished)
+
+    # STEP 1: Start the FIRST persona variation (creates the persona, always
+    # online) together with every task that does not depend on it
+    if persona_tasks:
+        if progress_callback:
+            progress_callback(0, total, 'Creating persona (first variation)...')
+        queue.put_nowait((persona_tasks[0], None))  # queue is still empty
+    submit([(task, None) for task in non_persona_tasks])
+
+    # STEP 2: Wait until every task is recorded; persona variations are
+    # submitted by the worker that finishes the persona. Feeders and batch
+    # jobs started later report through the same done callback, so none goes unwatched.
+    try:
+        await all_done.wait()
+        if failures:
+            raise failures[0]  # e.g. a progress_callback that raised
+    finally:
+        pending = [*workers, *runs]
+        for run in pending:
+            run.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    return results, errors
+
+
+def generate_all_images(
+    analysis: dict,
+    slide_paths: list[str],
+    product_image_path: str,
+    output_dir: str,
+    progress_callback: Optional[ImageProgressCallback] = None,
+    hook_variations: int = 1,
+    body_variations: int = 1,
+    product_variations: int = 1,
+    request_id: str = None,
+    use_batch_api: bool = USE_BATCH_API
+) -> dict:
+    """
+    Synchronous entry point for generate_all_images_async().
+
+    Runs the job on its own event loop via asyncio.run(), so call it from a
+    thread without a running loop (e.g. the per-request pipeline thread).
+    """
+    return asyncio.run(generate_all_images_async(
+        analysis, slide_paths, product_image_path, output_dir,
+        progress_callback, hook_variations, body_variations, product_variations,
+        request_id, use_batch_api
+    ))
 
 
 def run_pipeline(
@@ -1000,7 +1942,7 @@ def run_pipeline(
         if progress_callback:
             percent = 40 + int(50 * current / total)
             progress_callback('generating', message, percent)
-        log.debug(f"Generation progress: {current}/{total}")
+        log.debug("Generation progress: %d/%d", current, total)
 
     generation_result = generate_all_images(
         analysis,
@@ -6,6 +6,7 @@ Uses OAuth authentication (user grants access once, token is saved).
 """
 import os
 import pickle
+import threading
 import time
 from typing import Optional
 from dotenv import load_dotenv
@@ -87,10 +88,23 @@ def _get_credentials():
     return creds
 
 
+# Drive service per thread (the underlying httplib2 connection is not thread-safe)
+_thread_local = threading.local()
+
+
 def _get_service():
-    """Initialize and return Google Drive service using OAuth."""
-    credentials = _get_credentials()
-    return build('drive', 'v3', credentials=credentials)
+    """
+    Return this thread's Google Drive service using OAuth.
+
+    The service (token load + discovery document parse) is built once per
+    thread and reused until its credentials stop being valid.
+    """
+    credentials = getattr(_thread_local, 'credentials', None)
+    if credentials is None or not credentials.valid:
+        credentials = _get_credentials()
+        _thread_local.credentials = credentials
+        _thread_local.service = build('drive', 'v3', credentials=credentials)
+    return _thread_local.service
 
 
 def create_folder(folder_name: str, parent_id: Optional[str] = None) -> str:
@@ -251,6 +251,15 @@ def scrape_tiktok_slideshow(tiktok_url: str, output_dir: str, request_id: str =
             save_path = os.path.join(output_dir, f'slide_{i+1}.jpg')
             download_tasks.append((img_url, save_path, i))
 
+    # Audio URL (downloaded alongside the images rather than after them)
+    music = data.get('music')
+    audio_url = None
+    if music:
+        if isinstance(music, str):
+            audio_url = music
+        elif isinstance(music, dict):
+            audio_url = music.get('play_url') or music.get('play_url_music')
+
     # Download all images in parallel (max 8 concurrent)
     def download_task(task):
         url, path, idx = task
@@ -262,6 +271,12 @@ def scrape_tiktok_slideshow(tiktok_url: str, output_dir: str, request_id: str =
 
     log.debug(f"Starting parallel download of {len(download_tasks)} images (8 workers)")
     with ThreadPoolExecutor(max_workers=8) as executor:
+        audio_future = None
+        if audio_url:
+            log.debug("Downloading audio...")
+            audio_path = os.path.join(output_dir, 'audio.mp3')
+            audio_future = executor.submit(download_media, audio_url, audio_path, request_id=request_id)
+
         futures = [executor.submit(download_task, task) for task in download_tasks]
         downloaded = {}
         for future in as_completed(futures):
@@ -269,28 +284,17 @@ def scrape_tiktok_slideshow(tiktok_url: str, output_dir: str, request_id: str =
             if path:
                 downloaded[idx] = path
 
+        if audio_future:
+            try:
+                result['audio'] = audio_future.result()
+                log.debug("Audio downloaded successfully")
+            except TikTokScraperError:
+                log.warning("Audio download failed")
+
     # Maintain order
     result['images'] = [downloaded[i] for i in sorted(downloaded.keys())]
     log.info(f"Downloaded {len(result['images'])}/{len(images)} images")
 
-    # Extract and download audio (in parallel with nothing, but fast)
-    music = data.get('music')
-    audio_url = None
-    if music:
-        if isinstance(music, str):
-            audio_url = music
-        elif isinstance(music, dict):
-            audio_url = music.get('play_url') or music.get('play_url_music')
-    if audio_url:
-        log.debug("Downloading audio...")
-        audio_path = os.path.join(output_dir, 'audio.mp3')
-        try:
-            download_media(audio_url, audio_path, request_id=request_id)
-            result['audio'] = audio_path
-            log.debug("Audio downloaded successfully")
-        except TikTokScraperError:
-            log.warning("Audio download failed")
-
     if not result['images']:
         log.error("No slideshow images could be downloaded")
         raise TikTokScraperError('No slideshow images could be downloaded')